@@ -1,34 +1,122 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from bson import Binary
+from pymongo import IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-import bcrypt
-import jwt
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+import asyncio
+import json
+import zlib
+import hashlib
+import random
+import time
+from collections import deque
+import resource
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used when it is not installed
+    zstandard = None
+
+# bcrypt, jwt and emergentintegrations are imported where they are used so a
+# worker can bind its socket before the heavy LLM client stack is loaded.
+
+MODULE_IMPORTED = time.perf_counter()
+
+def process_age_seconds() -> tuple[float, str]:
+    """
+    Seconds since the OS started this process (so interpreter start-up and every
+    import are included). Falls back to time since this module was imported
+    where /proc is unavailable; the second value names which clock was used.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK'), "process_start"
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - MODULE_IMPORTED, "module_import"
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
+# The client is created in the app lifespan (or by connect_db() for CLI jobs);
+# pool size, timeouts and wire compression are tunable per deployment.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_CLIENT_OPTIONS = {
+    option: cast(os.environ[env_name])
+    for option, env_name, cast in [
+        ("maxPoolSize", "MONGO_MAX_POOL_SIZE", int),
+        ("minPoolSize", "MONGO_MIN_POOL_SIZE", int),
+        ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS", int),
+        ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+        ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS", int),
+        ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS", int),
+        ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS", int),
+        ("compressors", "MONGO_COMPRESSORS", str),
+    ]
+    if os.environ.get(env_name)
+}
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+def connect_db() -> AsyncIOMotorClient:
+    global client, db
+    client = AsyncIOMotorClient(mongo_url, **MONGO_CLIENT_OPTIONS)
+    db = client[os.environ['DB_NAME']]
+    return client
 
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET', 'spark-secret-key-2024')
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
 
-# Create the main app
-app = FastAPI()
+# History retention config
+# Rows beyond HISTORY_HOT_LIMIT per user are moved out of db.queries into compressed
+# db.query_archives batches. TTL values of 0 disable expiry; expired rows and archives
+# are deleted by the archiver (not TTL indexes) so blobs are released and the
+# pruned generations stay counted in user_stats.
+HISTORY_HOT_LIMIT = int(os.environ.get('HISTORY_HOT_LIMIT', '100'))
+HISTORY_TTL_DAYS = int(os.environ.get('HISTORY_TTL_DAYS', '0'))
+HISTORY_ARCHIVE_TTL_DAYS = int(os.environ.get('HISTORY_ARCHIVE_TTL_DAYS', '0'))
+HISTORY_ARCHIVE_BATCH_SIZE = int(os.environ.get('HISTORY_ARCHIVE_BATCH_SIZE', '200'))
+HISTORY_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('HISTORY_ARCHIVE_INTERVAL_SECONDS', '3600'))
+HISTORY_ARCHIVE_LEASE_SECONDS = int(os.environ.get('HISTORY_ARCHIVE_LEASE_SECONDS', '300'))
+
+# Batch generation config
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '10'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '3'))
+
+# Category examples config
+EXAMPLES_PER_CATEGORY = int(os.environ.get('EXAMPLES_PER_CATEGORY', '4'))
+EXAMPLES_REFRESH_HOURS = int(os.environ.get('EXAMPLES_REFRESH_HOURS', '24'))
+EXAMPLES_RELOAD_INTERVAL_SECONDS = int(os.environ.get('EXAMPLES_RELOAD_INTERVAL_SECONDS', '300'))
+EXAMPLES_CALLS_PER_MINUTE = float(os.environ.get('EXAMPLES_CALLS_PER_MINUTE', '4'))
+
+# Generation job queue config
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', '2'))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '120'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETRY_DELAY_SECONDS = int(os.environ.get('JOB_RETRY_DELAY_SECONDS', '10'))
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get('JOB_POLL_INTERVAL_SECONDS', '2'))
+JOB_MAX_WAIT_SECONDS = int(os.environ.get('JOB_MAX_WAIT_SECONDS', '30'))
+JOB_RETENTION_HOURS = int(os.environ.get('JOB_RETENTION_HOURS', '24'))
+
+# Shared idea view counting config
+VIEW_FLUSH_INTERVAL_SECONDS = float(os.environ.get('VIEW_FLUSH_INTERVAL_SECONDS', '10'))
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -62,6 +150,9 @@ class QueryRequest(BaseModel):
     category: str
     prompt: str
 
+class BatchQueryRequest(BaseModel):
+    items: List[QueryRequest]
+
 class SuggestionResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -70,6 +161,23 @@ class SuggestionResponse(BaseModel):
     suggestion: str
     created_at: str
 
+class ExampleResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    category: str
+    prompt: str
+    suggestion: str
+
+class JobResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    status: str  # queued, running, done, failed
+    category: str
+    prompt: str
+    result: Optional[SuggestionResponse] = None
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
+
 class FavoriteCreate(BaseModel):
     category: str
     prompt: str
@@ -116,6 +224,17 @@ class IdeaResponse(BaseModel):
     created_at: str
     updated_at: str
 
+class UserStatsResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    user_id: str
+    ideas: int = 0
+    favorites: int = 0
+    generations: int = 0
+    ideas_by_type: Dict[str, int] = {}
+    favorites_by_category: Dict[str, int] = {}
+    generations_by_category: Dict[str, int] = {}
+    updated_at: Optional[str] = None
+
 class SharedIdeaResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -124,17 +243,21 @@ class SharedIdeaResponse(BaseModel):
     idea_type: str
     media_url: Optional[str] = None
     author_name: str
+    view_count: int = 0
     created_at: str
 
 # ============== Auth Helpers ==============
 
 def hash_password(password: str) -> str:
+    import bcrypt
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
+    import bcrypt
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
 def create_token(user_id: str) -> str:
+    import jwt
     expiration = datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {
         "user_id": user_id,
@@ -143,6 +266,7 @@ def create_token(user_id: str) -> str:
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    import jwt
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id = payload.get("user_id")
@@ -193,6 +317,1022 @@ def check_content_moderation(text: str) -> tuple[bool, str]:
     
     return False, ""
 
+# ============== Usage Stats ==============
+
+# Per-user counters live in db.user_stats and are kept current with atomic $inc
+# updates from the write routes, so reading them never scans the source collections.
+STATS_REBUILD_BATCH_SIZE = int(os.environ.get('STATS_REBUILD_BATCH_SIZE', '500'))
+
+def stat_key(value: Optional[str]) -> str:
+    """Make a category / idea_type value safe to use as a Mongo field name."""
+    if not value:
+        return "unknown"
+    return value.replace(".", "_").replace("$", "_")
+
+async def bump_user_stats(user_id: str, kind: str, group_field: str, group_value: Optional[str], amount: int = 1):
+    await bump_user_stats_many(user_id, kind, group_field, {group_value: amount})
+
+async def bump_user_stats_many(user_id: str, kind: str, group_field: str, amounts: Dict[Optional[str], int]):
+    inc: Dict[str, int] = {kind: sum(amounts.values())}
+    for group_value, amount in amounts.items():
+        key = f"{group_field}.{stat_key(group_value)}"
+        inc[key] = inc.get(key, 0) + amount
+    # Counters are best-effort: the source write already succeeded and
+    # `rebuild-stats` repairs any drift, so a failure here must not fail the request
+    try:
+        await db.user_stats.update_one(
+            {"user_id": user_id},
+            {"$inc": inc, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.error(f"Usage stats update for {user_id} failed: {str(e)}")
+
+async def record_pruned_generations(pruned: Dict[str, Dict[str, int]]):
+    """
+    `generations` is a lifetime total. History removed by retention is tallied in
+    `pruned_generations_by_category` so rebuild_user_stats can add it back.
+    """
+    if not pruned:
+        return
+    ops = []
+    for user_id, counts in pruned.items():
+        inc = {f"pruned_generations_by_category.{stat_key(category)}": count for category, count in counts.items()}
+        ops.append(UpdateOne({"user_id": user_id}, {"$inc": inc}, upsert=True))
+    await db.user_stats.bulk_write(ops, ordered=False)
+
+async def _count_pruned_by_user(user_ids: List[str]) -> Dict[str, Dict[str, int]]:
+    counts: Dict[str, Dict[str, int]] = {}
+    cursor = db.user_stats.find(
+        {"user_id": {"$in": user_ids}},
+        {"_id": 0, "user_id": 1, "pruned_generations_by_category": 1}
+    )
+    async for stats in cursor:
+        if stats.get("pruned_generations_by_category"):
+            counts[stats["user_id"]] = stats["pruned_generations_by_category"]
+    return counts
+
+async def _count_archived_by_user(user_ids: List[str]) -> Dict[str, Dict[str, int]]:
+    pipeline = [
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$project": {"user_id": 1, "counts": {"$objectToArray": "$category_counts"}}},
+        {"$unwind": "$counts"},
+        {"$group": {"_id": {"user_id": "$user_id", "group": "$counts.k"}, "count": {"$sum": "$counts.v"}}}
+    ]
+    counts: Dict[str, Dict[str, int]] = {}
+    async for row in db.query_archives.aggregate(pipeline):
+        per_user = counts.setdefault(row["_id"]["user_id"], {})
+        per_user[row["_id"]["group"]] = per_user.get(row["_id"]["group"], 0) + row["count"]
+    return counts
+
+async def _count_by_user(collection, user_ids: List[str], group_field: str) -> Dict[str, Dict[str, int]]:
+    pipeline = [
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$group": {"_id": {"user_id": "$user_id", "group": f"${group_field}"}, "count": {"$sum": 1}}}
+    ]
+    counts: Dict[str, Dict[str, int]] = {}
+    async for row in collection.aggregate(pipeline):
+        key = stat_key(row["_id"].get("group"))
+        per_user = counts.setdefault(row["_id"]["user_id"], {})
+        per_user[key] = per_user.get(key, 0) + row["count"]
+    return counts
+
+async def rebuild_user_stats(batch_size: int = STATS_REBUILD_BATCH_SIZE) -> int:
+    """
+    Recompute every user's counters from ideas, favorites and queries.
+    Generations also include archived rows and the pruned tally kept by the
+    retention jobs, since that history no longer exists to be counted.
+    Users are processed in batches; returns the number of stats documents written.
+    """
+    written = 0
+    batch: List[str] = []
+
+    async def flush(user_ids: List[str]) -> int:
+        ideas = await _count_by_user(db.ideas, user_ids, "idea_type")
+        favorites = await _count_by_user(db.favorites, user_ids, "category")
+        generations = await _count_by_user(db.queries, user_ids, "category")
+        pruned = await _count_pruned_by_user(user_ids)
+        for extra in (await _count_archived_by_user(user_ids), pruned):
+            for user_id, counts in extra.items():
+                per_user = generations.setdefault(user_id, {})
+                for key, count in counts.items():
+                    per_user[key] = per_user.get(key, 0) + count
+        now = datetime.now(timezone.utc).isoformat()
+        ops = []
+        for user_id in user_ids:
+            ideas_by_type = ideas.get(user_id, {})
+            favorites_by_category = favorites.get(user_id, {})
+            generations_by_category = generations.get(user_id, {})
+            ops.append(ReplaceOne(
+                {"user_id": user_id},
+                {
+                    "user_id": user_id,
+                    "ideas": sum(ideas_by_type.values()),
+                    "favorites": sum(favorites_by_category.values()),
+                    "generations": sum(generations_by_category.values()),
+                    "ideas_by_type": ideas_by_type,
+                    "favorites_by_category": favorites_by_category,
+                    "generations_by_category": generations_by_category,
+                    "pruned_generations_by_category": pruned.get(user_id, {}),
+                    "updated_at": now
+                },
+                upsert=True
+            ))
+        await db.user_stats.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    async for user in db.users.find({}, {"_id": 0, "id": 1}):
+        batch.append(user["id"])
+        if len(batch) >= batch_size:
+            written += await flush(batch)
+            batch = []
+    if batch:
+        written += await flush(batch)
+
+    return written
+
+# ============== Suggestion Store ==============
+
+# Suggestion text is stored once per distinct value in db.suggestion_blobs, keyed
+# by its SHA-256 and compressed. Queries and favorites hold a `suggestion_hash`
+# instead of the text; blobs are reference counted and removed at zero refs.
+# Documents written before the store existed still carry an inline `suggestion`.
+SUGGESTION_MIGRATION_BATCH_SIZE = int(os.environ.get('SUGGESTION_MIGRATION_BATCH_SIZE', '500'))
+
+def suggestion_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def compress_suggestion(text: str) -> tuple[str, bytes]:
+    raw = text.encode('utf-8')
+    if zstandard is not None:
+        encoding, data = "zstd", zstandard.ZstdCompressor(level=9).compress(raw)
+    else:
+        encoding, data = "zlib", zlib.compress(raw, 9)
+    if len(data) >= len(raw):
+        return "raw", raw
+    return encoding, data
+
+def decompress_suggestion(encoding: str, data: bytes) -> str:
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd-compressed suggestions")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif encoding == "zlib":
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
+
+def _suggestion_upserts(texts: List[str]) -> List[tuple[UpdateOne, int]]:
+    refs: Dict[str, int] = {}
+    unique: Dict[str, str] = {}
+    for text in texts:
+        digest = suggestion_hash(text)
+        refs[digest] = refs.get(digest, 0) + 1
+        unique[digest] = text
+    ops = []
+    for digest, count in refs.items():
+        encoding, data = compress_suggestion(unique[digest])
+        ops.append((UpdateOne(
+            {"_id": digest},
+            {
+                "$setOnInsert": {
+                    "encoding": encoding,
+                    "data": Binary(data),
+                    "size": len(unique[digest].encode('utf-8')),
+                    "stored_size": len(data)
+                },
+                "$inc": {"refs": count}
+            },
+            upsert=True
+        ), len(data)))
+    return ops
+
+async def store_suggestions(texts: List[str]) -> List[str]:
+    """Add a reference to the blob of each text, creating blobs as needed; returns the hashes."""
+    ops = _suggestion_upserts(texts)
+    if ops:
+        await db.suggestion_blobs.bulk_write([op for op, _ in ops], ordered=False)
+    return [suggestion_hash(text) for text in texts]
+
+async def release_suggestions(hashes: List[Optional[str]]):
+    refs: Dict[str, int] = {}
+    for digest in hashes:
+        if digest:
+            refs[digest] = refs.get(digest, 0) + 1
+    if not refs:
+        return
+    await db.suggestion_blobs.bulk_write(
+        [UpdateOne({"_id": digest}, {"$inc": {"refs": -count}}) for digest, count in refs.items()],
+        ordered=False
+    )
+    await db.suggestion_blobs.delete_many({"_id": {"$in": list(refs)}, "refs": {"$lte": 0}})
+
+async def externalize_suggestions(docs: List[dict]) -> List[dict]:
+    """Return copies of `docs` with the inline suggestion text swapped for a blob reference."""
+    hashes = await store_suggestions([doc["suggestion"] for doc in docs])
+    stored = []
+    for doc, digest in zip(docs, hashes):
+        stored_doc = {key: value for key, value in doc.items() if key != "suggestion"}
+        stored_doc["suggestion_hash"] = digest
+        stored.append(stored_doc)
+    return stored
+
+async def resolve_suggestions(docs: List[dict]) -> List[dict]:
+    """Fill in `suggestion` text in place for documents that reference a blob."""
+    hashes = {doc["suggestion_hash"] for doc in docs if doc.get("suggestion_hash")}
+    if not hashes:
+        return docs
+    texts = {}
+    async for blob in db.suggestion_blobs.find({"_id": {"$in": list(hashes)}}):
+        texts[blob["_id"]] = decompress_suggestion(blob["encoding"], blob["data"])
+    missing = hashes - texts.keys()
+    if missing:
+        # A referenced blob should never be gone; this means a refcount was released too often
+        logger.error(f"Suggestion blobs missing for {len(missing)} references: {sorted(missing)}")
+    for doc in docs:
+        digest = doc.pop("suggestion_hash", None)
+        if digest:
+            doc["suggestion"] = texts.get(digest, "")
+    return docs
+
+async def migrate_suggestions(batch_size: int = SUGGESTION_MIGRATION_BATCH_SIZE) -> dict:
+    """
+    Move inline suggestion text in queries and favorites into the blob store,
+    in batches. Returns a report of the bytes before and after.
+    """
+    report = {"documents": 0, "inline_bytes": 0, "new_blobs": 0, "new_blob_bytes": 0}
+    for collection in (db.queries, db.favorites):
+        while True:
+            docs = await collection.find(
+                {"suggestion": {"$type": "string"}},
+                {"_id": 1, "suggestion": 1}
+            ).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+
+            texts = [doc["suggestion"] for doc in docs]
+            ops = _suggestion_upserts(texts)
+            result = await db.suggestion_blobs.bulk_write([op for op, _ in ops], ordered=False)
+            for index in result.upserted_ids:
+                report["new_blobs"] += 1
+                report["new_blob_bytes"] += ops[index][1]
+
+            # Only rewrite a document whose text is still the one just stored, and hand
+            # back the reference for any that changed or were migrated concurrently
+            results = await asyncio.gather(*[
+                collection.update_one(
+                    {"_id": doc["_id"], "suggestion": doc["suggestion"]},
+                    {"$set": {"suggestion_hash": suggestion_hash(doc["suggestion"])}, "$unset": {"suggestion": ""}}
+                )
+                for doc in docs
+            ])
+            migrated = [text for text, result in zip(texts, results) if result.modified_count]
+            await release_suggestions([
+                suggestion_hash(text) for text, result in zip(texts, results) if not result.modified_count
+            ])
+            report["documents"] += len(migrated)
+            report["inline_bytes"] += sum(len(text.encode('utf-8')) for text in migrated)
+
+    report["saved_bytes"] = report["inline_bytes"] - report["new_blob_bytes"]
+    if report["inline_bytes"]:
+        report["saved_percent"] = round(100 * report["saved_bytes"] / report["inline_bytes"], 1)
+    return report
+
+# ============== Cluster Leases ==============
+
+async def claim_cluster_lease(name: str, owner: str, seconds: float) -> bool:
+    """
+    Take (or renew, for the same owner) a named lease shared by every worker.
+    Used to run cluster-wide background jobs in exactly one process at a time.
+    """
+    now = datetime.now(timezone.utc)
+    try:
+        await db.cluster_leases.find_one_and_update(
+            {"_id": name, "$or": [{"owner": owner}, {"lock_until": {"$not": {"$gt": now}}}]},
+            {"$set": {"owner": owner, "lock_until": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Held by another worker and not yet expired
+        return False
+    return True
+
+# ============== History Retention ==============
+
+def history_expiry(now: datetime, days: int) -> Optional[datetime]:
+    return now + timedelta(days=days) if days > 0 else None
+
+def pack_history(rows: List[dict]) -> Binary:
+    return Binary(zlib.compress(json.dumps(rows, separators=(",", ":")).encode('utf-8')))
+
+def unpack_history(payload: bytes) -> List[dict]:
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+async def claim_archive_lease(user_id: str, owner: str) -> bool:
+    """Take (or extend, for the same owner) the per-user archiver lease."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.history_archive_locks.find_one_and_update(
+            {
+                "user_id": user_id,
+                "$or": [{"owner": owner}, {"lock_until": {"$not": {"$gt": now}}}]
+            },
+            {"$set": {"owner": owner, "lock_until": now + timedelta(seconds=HISTORY_ARCHIVE_LEASE_SECONDS)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease on this user
+        return False
+    return True
+
+async def release_archive_lease(user_id: str, owner: str):
+    await db.history_archive_locks.delete_one({"user_id": user_id, "owner": owner})
+
+async def archive_user_history(user_id: str, keep: int = HISTORY_HOT_LIMIT, batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Move a user's query rows older than the newest `keep` into compressed archive
+    documents of at most `batch_size` rows each. Returns the number of rows moved.
+    Only one worker archives a given user at a time; others skip the user.
+    """
+    owner = str(uuid.uuid4())
+    moved = 0
+    try:
+        while await claim_archive_lease(user_id, owner):
+            rows = await db.queries.find(
+                {"user_id": user_id},
+                {"_id": 0, "expires_at": 0}
+            ).sort("created_at", -1).skip(keep).limit(batch_size).to_list(batch_size)
+            if not rows:
+                break
+            moved += await _archive_rows(user_id, rows)
+    finally:
+        await release_archive_lease(user_id, owner)
+    return moved
+
+async def _archive_rows(user_id: str, rows: List[dict]) -> int:
+    hashes = {row["id"]: row.get("suggestion_hash") for row in rows}
+    await resolve_suggestions(rows)
+
+    now = datetime.now(timezone.utc)
+    archive_doc = {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "encoding": "zlib+json",
+        "archived_at": now.isoformat(),
+        **_archive_body(rows)
+    }
+    expires_at = history_expiry(now, HISTORY_ARCHIVE_TTL_DAYS)
+    if expires_at:
+        archive_doc["expires_at"] = expires_at
+
+    # Write the archive before deleting so a crash can only duplicate, never lose, rows
+    await db.query_archives.insert_one(archive_doc)
+
+    # Only rows this call actually deleted are archived and have their blobs released;
+    # anything already removed elsewhere (TTL, another process) is dropped from the archive
+    deleted = []
+    for row in rows:
+        result = await db.queries.delete_one({"id": row["id"]})
+        if result.deleted_count:
+            deleted.append(row)
+    if not deleted:
+        await db.query_archives.delete_one({"id": archive_doc["id"]})
+    elif len(deleted) < len(rows):
+        await db.query_archives.update_one({"id": archive_doc["id"]}, {"$set": _archive_body(deleted)})
+
+    await release_suggestions([hashes[row["id"]] for row in deleted])
+    return len(deleted)
+
+def _archive_body(rows: List[dict]) -> dict:
+    category_counts: Dict[str, int] = {}
+    for row in rows:
+        key = stat_key(row.get("category"))
+        category_counts[key] = category_counts.get(key, 0) + 1
+    return {
+        "count": len(rows),
+        "first_created_at": rows[-1]["created_at"],
+        "last_created_at": rows[0]["created_at"],
+        "category_counts": category_counts,
+        "payload": pack_history(rows)
+    }
+
+async def archive_history(keep: int = HISTORY_HOT_LIMIT, batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE) -> int:
+    pipeline = [
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": keep}}}
+    ]
+    moved = 0
+    async for row in db.queries.aggregate(pipeline, allowDiskUse=True):
+        if row["_id"]:
+            moved += await archive_user_history(row["_id"], keep, batch_size)
+    return moved
+
+async def purge_expired_history(batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Delete query rows past their `expires_at` and release their suggestion blobs.
+    db.queries has no TTL index because a TTL delete could not release blob refs
+    or record the pruned generations.
+    """
+    purged = 0
+    while True:
+        rows = await db.queries.find(
+            {"expires_at": {"$lte": datetime.now(timezone.utc)}},
+            {"_id": 0, "id": 1, "user_id": 1, "category": 1, "suggestion_hash": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not rows:
+            return purged
+        released = []
+        pruned: Dict[str, Dict[str, int]] = {}
+        for row in rows:
+            result = await db.queries.delete_one({"id": row["id"]})
+            if result.deleted_count:
+                released.append(row.get("suggestion_hash"))
+                per_user = pruned.setdefault(row["user_id"], {})
+                per_user[row.get("category")] = per_user.get(row.get("category"), 0) + 1
+        await record_pruned_generations(pruned)
+        await release_suggestions(released)
+        purged += len(released)
+
+async def purge_expired_archives(batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE) -> int:
+    """Delete archive documents past their `expires_at`, tallying their rows as pruned."""
+    purged = 0
+    while True:
+        archives = await db.query_archives.find(
+            {"expires_at": {"$lte": datetime.now(timezone.utc)}},
+            {"_id": 0, "id": 1, "user_id": 1, "category_counts": 1}
+        ).limit(batch_size).to_list(batch_size)
+        if not archives:
+            return purged
+        pruned: Dict[str, Dict[str, int]] = {}
+        for archive in archives:
+            result = await db.query_archives.delete_one({"id": archive["id"]})
+            if result.deleted_count:
+                per_user = pruned.setdefault(archive["user_id"], {})
+                for category, count in archive.get("category_counts", {}).items():
+                    per_user[category] = per_user.get(category, 0) + count
+                purged += 1
+        await record_pruned_generations(pruned)
+
+async def run_history_retention(keep: int = HISTORY_HOT_LIMIT, batch_size: int = HISTORY_ARCHIVE_BATCH_SIZE) -> tuple[int, int, int]:
+    """One retention pass: expire hot rows and archives, then archive past the hot cap."""
+    purged = await purge_expired_history(batch_size)
+    expired_archives = await purge_expired_archives(batch_size)
+    moved = await archive_history(keep, batch_size)
+    return purged, expired_archives, moved
+
+async def run_history_archiver():
+    owner = str(uuid.uuid4())
+    while True:
+        try:
+            # One worker in the cluster sweeps per interval; the $group over all of
+            # db.queries is too expensive to repeat in every process
+            if await claim_cluster_lease("history-retention", owner, HISTORY_ARCHIVE_INTERVAL_SECONDS):
+                purged, expired_archives, moved = await run_history_retention()
+                if purged or expired_archives or moved:
+                    logger.info(f"History retention: purged {purged} rows and {expired_archives} archives, archived {moved} rows")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"History archiver error: {str(e)}")
+        await asyncio.sleep(HISTORY_ARCHIVE_INTERVAL_SECONDS)
+
+# ============== LLM Warm-up ==============
+
+# emergentintegrations pulls in litellm and the provider SDKs, which dominate
+# import time and memory. They are loaded in a worker thread during startup;
+# requests that arrive first simply wait for the load to finish.
+llm_classes: Optional[tuple] = None
+llm_warmup_done = asyncio.Event()
+warmup_report: Dict[str, object] = {}
+
+def _import_llm_classes() -> tuple:
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    return LlmChat, UserMessage
+
+async def warm_up_llm():
+    global llm_classes
+    started = time.perf_counter()
+    try:
+        llm_classes = await asyncio.to_thread(_import_llm_classes)
+    except Exception as e:
+        logger.error(f"LLM warm-up failed: {str(e)}")
+    finally:
+        warmup_report["llm_import_seconds"] = round(time.perf_counter() - started, 3)
+        cold_start, cold_start_clock = process_age_seconds()
+        warmup_report["cold_start_seconds"] = round(cold_start, 3)
+        warmup_report["cold_start_measured_from"] = cold_start_clock
+        warmup_report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        llm_warmup_done.set()
+        logger.info(f"Worker {os.getpid()} warm-up finished: {warmup_report}")
+
+async def get_llm_classes() -> tuple:
+    global llm_classes
+    await llm_warmup_done.wait()
+    if llm_classes is None:
+        llm_classes = await asyncio.to_thread(_import_llm_classes)
+    return llm_classes
+
+# ============== LLM Upstream ==============
+
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'openai')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gpt-5.2')
+# Cheaper model used while the breaker is open or after a primary failure; unset disables fallback
+LLM_FALLBACK_MODEL = os.environ.get('LLM_FALLBACK_MODEL')
+
+# Hedging fires a second identical request once the first has run longer than
+# the observed p95 latency, and keeps whichever answer arrives first.
+LLM_HEDGE_ENABLED = os.environ.get('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('LLM_HEDGE_MIN_DELAY_SECONDS', '2'))
+LLM_HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('LLM_HEDGE_DEFAULT_DELAY_SECONDS', '15'))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', '20'))
+# At most this fraction of calls may be hedged (with a small burst allowance), so a
+# degraded upstream that pushes every call past p95 doesn't see its load doubled
+LLM_HEDGE_BUDGET_RATIO = float(os.environ.get('LLM_HEDGE_BUDGET_RATIO', '0.05'))
+LLM_HEDGE_BUDGET_BURST = float(os.environ.get('LLM_HEDGE_BUDGET_BURST', '5'))
+
+LLM_BREAKER_WINDOW = int(os.environ.get('LLM_BREAKER_WINDOW', '20'))
+LLM_BREAKER_MIN_CALLS = int(os.environ.get('LLM_BREAKER_MIN_CALLS', '5'))
+LLM_BREAKER_ERROR_RATE = float(os.environ.get('LLM_BREAKER_ERROR_RATE', '0.5'))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS', '30'))
+
+class LlmUnavailableError(Exception):
+    pass
+
+class CircuitBreaker:
+    """
+    Error-rate breaker over the last `window` calls. Once open it rejects calls
+    for `cooldown` seconds, then lets a single probe through (half-open); the
+    probe's outcome closes or re-opens it.
+
+    `allow()` hands out a ticket naming the breaker generation the call was
+    admitted in. Every state change starts a new generation, so results from
+    calls admitted before the change (e.g. slow calls that were already in
+    flight when the breaker opened) are ignored by `record()`.
+    """
+
+    def __init__(self, window: int, min_calls: int, error_rate: float, cooldown: float):
+        self.results: deque = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate_threshold = error_rate
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.generation = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+        self.times_opened = 0
+
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def allow(self) -> Optional[int]:
+        """Return a ticket to pass to record(), or None if the call is rejected."""
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self._transition("half_open")
+        if self.state == "closed":
+            return self.generation
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return self.generation
+        return None
+
+    def record(self, ticket: int, success: bool):
+        if ticket != self.generation:
+            return
+        if self.state == "half_open":
+            if success:
+                self._transition("closed")
+            else:
+                self._open()
+            return
+        self.results.append(success)
+        if len(self.results) >= self.min_calls and self.error_rate() >= self.error_rate_threshold:
+            self._open()
+
+    def abandon(self, ticket: int):
+        """The call never finished (cancelled); let another probe through if it was the probe."""
+        if ticket == self.generation and self.state == "half_open":
+            self.probe_in_flight = False
+
+    def _open(self):
+        self._transition("open")
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+
+    def _transition(self, state: str):
+        self.state = state
+        self.generation += 1
+        self.probe_in_flight = False
+        self.results.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "generation": self.generation,
+            "error_rate": round(self.error_rate(), 3),
+            "window_calls": len(self.results),
+            "times_opened": self.times_opened
+        }
+
+class HedgeBudget:
+    """Token bucket: every hedgeable call earns `ratio` tokens (up to `burst`), a hedge spends one."""
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_WINDOW, LLM_BREAKER_MIN_CALLS, LLM_BREAKER_ERROR_RATE, LLM_BREAKER_COOLDOWN_SECONDS)
+llm_latencies: deque = deque(maxlen=500)
+llm_metrics: Dict[str, int] = {
+    "calls": 0,
+    "errors": 0,
+    "hedges_fired": 0,
+    "hedge_wins": 0,
+    "fallback_calls": 0,
+    "rejected": 0,
+    "hedges_over_budget": 0
+}
+hedge_budget = HedgeBudget(LLM_HEDGE_BUDGET_RATIO, LLM_HEDGE_BUDGET_BURST)
+
+def llm_latency_p95(samples=None) -> Optional[float]:
+    samples = llm_latencies if samples is None else samples
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+def hedge_delay(samples=None) -> float:
+    samples = llm_latencies if samples is None else samples
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_DEFAULT_DELAY_SECONDS
+    return max(LLM_HEDGE_MIN_DELAY_SECONDS, llm_latency_p95(samples))
+
+async def _send_llm(model: str, system_prompt: str, prompt: str, session_prefix: str, record_latency: bool = True) -> str:
+    LlmChat, UserMessage = await get_llm_classes()
+    chat = LlmChat(
+        api_key=os.environ.get('EMERGENT_LLM_KEY'),
+        session_id=f"{session_prefix}-{uuid.uuid4()}",
+        system_message=system_prompt
+    ).with_model(LLM_PROVIDER, model)
+    started = time.perf_counter()
+    response = await chat.send_message(UserMessage(text=prompt))
+    if record_latency:
+        llm_latencies.append(time.perf_counter() - started)
+    return response
+
+async def _send_hedged(model: str, system_prompt: str, prompt: str, session_prefix: str) -> str:
+    hedge_budget.earn()
+    started: Dict[asyncio.Task, float] = {}
+
+    def launch() -> asyncio.Task:
+        task = asyncio.create_task(_send_llm(model, system_prompt, prompt, session_prefix))
+        started[task] = time.perf_counter()
+        return task
+
+    first = launch()
+    pending = {first}
+    hedge: Optional[asyncio.Task] = None
+    error: Optional[BaseException] = None
+    # Everything still pending is cancelled on the way out, including when the
+    # caller itself is cancelled, so no upstream call outlives the request
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge_delay())
+        if done:
+            return first.result()
+
+        if hedge_budget.try_spend():
+            llm_metrics["hedges_fired"] += 1
+            hedge = launch()
+            pending = {first, hedge}
+        else:
+            llm_metrics["hedges_over_budget"] += 1
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        llm_metrics["hedge_wins"] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+            # A cancelled loser never reports its latency. Its elapsed time is a lower
+            # bound, and recording it keeps p95 from drifting low under hedging
+            llm_latencies.append(time.perf_counter() - started[task])
+
+async def complete_llm(system_prompt: str, prompt: str, session_prefix: str) -> str:
+    """
+    Send one prompt upstream through the circuit breaker, hedging when enabled
+    and falling back to LLM_FALLBACK_MODEL when the primary model is failing.
+    Raises LlmUnavailableError when the breaker is open and no fallback is set.
+    """
+    ticket = llm_breaker.allow()
+    if ticket is not None:
+        llm_metrics["calls"] += 1
+        try:
+            if LLM_HEDGE_ENABLED:
+                response = await _send_hedged(LLM_MODEL, system_prompt, prompt, session_prefix)
+            else:
+                response = await _send_llm(LLM_MODEL, system_prompt, prompt, session_prefix)
+        except asyncio.CancelledError:
+            llm_breaker.abandon(ticket)
+            raise
+        except Exception as e:
+            llm_metrics["errors"] += 1
+            llm_breaker.record(ticket, False)
+            if not LLM_FALLBACK_MODEL:
+                raise
+            logger.warning(f"Primary model failed, using fallback: {str(e)}")
+        else:
+            llm_breaker.record(ticket, True)
+            return response
+    elif not LLM_FALLBACK_MODEL:
+        llm_metrics["rejected"] += 1
+        raise LlmUnavailableError("LLM circuit breaker is open")
+
+    llm_metrics["fallback_calls"] += 1
+    return await _send_llm(LLM_FALLBACK_MODEL, system_prompt, prompt, session_prefix)
+
+# ============== Background Work ==============
+
+# Fire-and-forget tasks spawned from request handlers; holding a reference keeps
+# them from being garbage collected before they finish.
+detached_tasks: set = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    return task
+
+# ============== Generation Jobs ==============
+
+# Jobs live in db.generation_jobs so they survive restarts. Workers claim a job
+# by taking a lease; a job whose lease ran out (worker died mid-call) is claimed
+# again. Completion wakes long-pollers in this process, other processes poll.
+job_queue_signal = asyncio.Event()
+job_waiters: Dict[str, asyncio.Event] = {}
+
+def job_terminal(job: dict) -> bool:
+    return job["status"] in ("done", "failed")
+
+async def fail_exhausted_jobs(now: datetime) -> int:
+    """
+    Fail jobs whose lease expired on their last allowed attempt. A worker that
+    keeps dying mid-job would otherwise have the job reclaimed forever.
+    """
+    result = await db.generation_jobs.update_many(
+        {
+            "status": "running",
+            "lease_expires_at": {"$lte": now},
+            "attempts": {"$gte": JOB_MAX_ATTEMPTS}
+        },
+        {
+            "$set": {
+                "status": "failed",
+                "error": "Failed to generate suggestion",
+                "updated_at": now.isoformat(),
+                "expires_at": now + timedelta(hours=JOB_RETENTION_HOURS)
+            },
+            "$unset": {"lease_expires_at": "", "lease_token": ""}
+        }
+    )
+    if result.modified_count:
+        logger.warning(f"Failed {result.modified_count} generation jobs after {JOB_MAX_ATTEMPTS} expired leases")
+    return result.modified_count
+
+async def claim_job() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    await fail_exhausted_jobs(now)
+    return await db.generation_jobs.find_one_and_update(
+        {
+            "$or": [
+                {"status": "queued", "available_at": {"$lte": now}},
+                {
+                    "status": "running",
+                    "lease_expires_at": {"$lte": now},
+                    "attempts": {"$lt": JOB_MAX_ATTEMPTS}
+                }
+            ]
+        },
+        {
+            "$set": {
+                "status": "running",
+                "lease_token": str(uuid.uuid4()),
+                "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "updated_at": now.isoformat()
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def finish_job(job: dict, update: dict, inc: Optional[dict] = None) -> bool:
+    """
+    Write the outcome of a claimed job. The write only lands while this worker
+    still holds the lease; returns False if another worker has taken it over.
+    """
+    now = datetime.now(timezone.utc)
+    update["updated_at"] = now.isoformat()
+    if update["status"] in ("done", "failed"):
+        update["expires_at"] = now + timedelta(hours=JOB_RETENTION_HOURS)
+    change = {"$set": update, "$unset": {"lease_expires_at": "", "lease_token": ""}}
+    if inc:
+        change["$inc"] = inc
+    result = await db.generation_jobs.update_one(
+        {"id": job["id"], "lease_token": job["lease_token"]},
+        change
+    )
+    if result.matched_count == 0:
+        logger.warning(f"Generation job {job['id']} lease lost before its result was written")
+        return False
+    waiter = job_waiters.get(job["id"])
+    if waiter:
+        waiter.set()
+    return True
+
+async def keep_job_leased(job: dict):
+    """Extend the lease while the job runs; returns once the lease has been lost."""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            result = await db.generation_jobs.update_one(
+                {"id": job["id"], "lease_token": job["lease_token"]},
+                {"$set": {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            logger.warning(f"Generation job {job['id']} lease renewal failed: {str(e)}")
+            continue
+        if result.matched_count == 0:
+            return
+
+async def generate_for_job(job: dict) -> SuggestionResponse:
+    # The history row uses the job id, so a retry after the row was saved reuses it
+    existing = await db.queries.find_one({"id": job["id"]}, {"_id": 0})
+    if existing:
+        await resolve_suggestions([existing])
+        return SuggestionResponse(**existing)
+    return await create_suggestion(job["user_id"], job["category"], job["prompt"], suggestion_id=job["id"])
+
+async def process_job(job: dict):
+    work = asyncio.create_task(generate_for_job(job))
+    heartbeat = asyncio.create_task(keep_job_leased(job))
+    try:
+        done, _ = await asyncio.wait({work, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # Shutting down: stop the call and hand the job straight back to the queue
+        # instead of leaving it "running" until the lease expires
+        work.cancel()
+        heartbeat.cancel()
+        await asyncio.gather(work, heartbeat, return_exceptions=True)
+        try:
+            await finish_job(
+                job,
+                {"status": "queued", "available_at": datetime.now(timezone.utc)},
+                inc={"attempts": -1}
+            )
+        except Exception as e:
+            logger.error(f"Generation job {job['id']} could not be requeued: {str(e)}")
+        raise
+    heartbeat.cancel()
+    if work not in done:
+        logger.warning(f"Generation job {job['id']} lease lost, abandoning attempt {job['attempts']}")
+        work.cancel()
+        return
+
+    try:
+        suggestion = work.result()
+    except Exception as e:
+        logger.error(f"Generation job {job['id']} attempt {job['attempts']} failed: {str(e)}")
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            await finish_job(job, {"status": "failed", "error": "Failed to generate suggestion"})
+        else:
+            await finish_job(job, {
+                "status": "queued",
+                "available_at": datetime.now(timezone.utc) + timedelta(seconds=JOB_RETRY_DELAY_SECONDS)
+            })
+        return
+    await finish_job(job, {"status": "done", **pack_job_result(suggestion), "error": None})
+
+async def run_generation_worker():
+    while True:
+        try:
+            job = await claim_job()
+            if job:
+                await process_job(job)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Generation worker error: {str(e)}")
+        try:
+            job_queue_signal.clear()
+            await asyncio.wait_for(job_queue_signal.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Generation worker wait error: {str(e)}")
+            await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
+
+def pack_job_result(suggestion: SuggestionResponse) -> dict:
+    """Store a finished job's suggestion text compressed, alongside the other result fields."""
+    result = suggestion.model_dump()
+    encoding, data = compress_suggestion(result.pop("suggestion"))
+    return {"result": result, "result_encoding": encoding, "result_data": Binary(data)}
+
+def unpack_job_result(job: dict) -> dict:
+    data = job.pop("result_data", None)
+    encoding = job.pop("result_encoding", None)
+    if job.get("result") and data is not None:
+        job["result"]["suggestion"] = decompress_suggestion(encoding, data)
+    return job
+
+async def wait_for_job(job_id: str, user_id: str, timeout: float) -> Optional[dict]:
+    deadline = time.monotonic() + timeout
+    waiter = job_waiters.setdefault(job_id, asyncio.Event())
+    try:
+        while True:
+            job = await db.generation_jobs.find_one({"id": job_id, "user_id": user_id}, {"_id": 0})
+            remaining = deadline - time.monotonic()
+            if not job or job_terminal(job) or remaining <= 0:
+                return unpack_job_result(job) if job else None
+            try:
+                await asyncio.wait_for(waiter.wait(), timeout=min(JOB_POLL_INTERVAL_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        job_waiters.pop(job_id, None)
+
+# ============== Shared Idea Views ==============
+
+# Views of public ideas are counted in memory and written out periodically as one
+# bulk_write, keeping Mongo writes off the unauthenticated read path. Counts not
+# yet flushed are lost only if the process dies without a clean shutdown.
+pending_views: Dict[str, int] = {}
+
+def record_view(share_id: str):
+    pending_views[share_id] = pending_views.get(share_id, 0) + 1
+
+def unapplied_views(write: asyncio.Future, share_ids: List[str]) -> List[str]:
+    """Share ids from a finished view-count bulk write whose increments did not land."""
+    if write.cancelled():
+        return share_ids
+    error = write.exception()
+    if error is None:
+        return []
+    if isinstance(error, BulkWriteError):
+        return [share_ids[write_error["index"]] for write_error in error.details.get("writeErrors", [])]
+    # Nothing is known to have landed; retrying may count a view twice, dropping would lose it
+    return share_ids
+
+async def flush_view_counts() -> int:
+    global pending_views
+    if not pending_views:
+        return 0
+    views, pending_views = pending_views, {}
+    share_ids = list(views)
+    write = asyncio.ensure_future(db.ideas.bulk_write(
+        [UpdateOne({"share_id": share_id}, {"$inc": {"view_count": views[share_id]}}) for share_id in share_ids],
+        ordered=False
+    ))
+    try:
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        # Let an in-flight write finish so only the counts it did not apply are kept
+        await asyncio.wait([write])
+        raise
+    finally:
+        # Put back what did not land so the next flush, or the final drain at shutdown, retries it
+        for share_id in unapplied_views(write, share_ids):
+            pending_views[share_id] = pending_views.get(share_id, 0) + views[share_id]
+    return len(views)
+
+async def run_view_flusher():
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_INTERVAL_SECONDS)
+        try:
+            await flush_view_counts()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"View count flush error: {str(e)}")
+
 # ============== Category Prompts ==============
 
 CATEGORY_PROMPTS = {
@@ -221,12 +1361,178 @@ content ideas for blogs, social media, videos, or other creative platforms.
 Provide 3 distinct creative content suggestions based on the user's input."""
 }
 
+# ============== Category Examples ==============
+
+# Seed prompts the example pool is drawn from; each refresh answers a random
+# subset so the examples rotate over time.
+EXAMPLE_SEED_PROMPTS = {
+    "writing": [
+        "A short story that starts in a lighthouse during a power cut",
+        "A poem about the last day of summer holidays",
+        "A mystery where the only witness is a parrot",
+        "A letter written by a time traveller to their younger self",
+        "Opening lines for a cosy fantasy novel set in a bakery",
+        "A sci-fi story about a city that runs entirely on music"
+    ],
+    "design": [
+        "A logo concept for a neighbourhood plant shop",
+        "A colour palette for a calm meditation app",
+        "A poster layout for an indie film festival",
+        "Packaging ideas for a handmade chocolate brand",
+        "A personal portfolio homepage for an illustrator",
+        "A moodboard direction for a retro-futuristic café"
+    ],
+    "problem-solving": [
+        "How can a small team run meetings that finish on time?",
+        "Ways to get neighbours involved in a community garden",
+        "How to keep a shared kitchen clean without arguments",
+        "Making a long daily commute feel productive",
+        "Reducing food waste in a busy family household",
+        "Getting a book club to actually finish the books"
+    ],
+    "gift-ideas": [
+        "A birthday gift for a friend who loves hiking and coffee",
+        "A retirement present for a teacher of 30 years",
+        "Something thoughtful for a new parent under $50",
+        "A housewarming gift for someone who just moved abroad",
+        "An anniversary gift for a couple who love board games",
+        "A thank-you gift for a mentor who enjoys gardening"
+    ],
+    "project-names": [
+        "A mobile app that helps people swap houseplants",
+        "A podcast about forgotten inventions",
+        "A small-batch hot sauce company",
+        "An open-source tool for organising recipes",
+        "A weekend workshop series teaching pottery",
+        "A newsletter about slow travel by train"
+    ],
+    "content-ideas": [
+        "A YouTube series for beginner home cooks",
+        "Instagram posts for a local bookstore",
+        "Blog topics for a freelance photographer",
+        "A TikTok series explaining everyday science",
+        "Newsletter themes for a running club",
+        "LinkedIn posts for a first-time startup founder"
+    ]
+}
+
+# Served from memory; every worker reloads the shared pool from db.category_examples
+example_pool: Dict[str, List[dict]] = {}
+
+async def load_examples():
+    async for doc in db.category_examples.find({}, {"_id": 0, "category": 1, "examples": 1}):
+        if doc.get("examples"):
+            example_pool[doc["category"]] = doc["examples"]
+
+async def claim_example_refresher(owner: str) -> bool:
+    """
+    Take (or renew) the single cluster-wide refresher lease. Only the holder calls
+    the LLM, so EXAMPLES_CALLS_PER_MINUTE is the budget for all workers together.
+    """
+    return await claim_cluster_lease("examples", owner, 30 * 60)
+
+async def claim_example_refresh(category: str) -> bool:
+    """Take the refresh lock for a category whose pool is missing or stale."""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.category_examples.find_one_and_update(
+            {
+                "category": category,
+                "refreshed_at": {"$not": {"$gt": now - timedelta(hours=EXAMPLES_REFRESH_HOURS)}},
+                "lock_until": {"$not": {"$gt": now}}
+            },
+            {"$set": {"lock_until": now + timedelta(minutes=30)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The document exists but is fresh or locked by another worker
+        return False
+    return True
+
+async def refresh_category_examples(category: str):
+    examples = []
+    seeds = random.sample(EXAMPLE_SEED_PROMPTS[category], min(EXAMPLES_PER_CATEGORY, len(EXAMPLE_SEED_PROMPTS[category])))
+    for prompt in seeds:
+        try:
+            # Background traffic goes straight upstream so its failures and latency
+            # don't feed the breaker and p95 that user requests rely on
+            suggestion = await _send_llm(LLM_MODEL, CATEGORY_PROMPTS[category], prompt, "spark-examples", record_latency=False)
+        except Exception as e:
+            logger.warning(f"Example generation for {category} failed: {str(e)}")
+        else:
+            if not check_content_moderation(suggestion)[0]:
+                examples.append({"category": category, "prompt": prompt, "suggestion": suggestion})
+        # Stay within the upstream budget reserved for examples
+        await asyncio.sleep(60 / EXAMPLES_CALLS_PER_MINUTE)
+
+    update = {"$unset": {"lock_until": ""}}
+    if examples:
+        update["$set"] = {"examples": examples, "refreshed_at": datetime.now(timezone.utc)}
+        example_pool[category] = examples
+    await db.category_examples.update_one({"category": category}, update)
+
+async def run_example_refresher():
+    owner = str(uuid.uuid4())
+    while True:
+        try:
+            await load_examples()
+            if os.environ.get('EMERGENT_LLM_KEY') and EXAMPLES_CALLS_PER_MINUTE > 0:
+                for category in CATEGORY_PROMPTS:
+                    if llm_breaker.state != "closed" or not await claim_example_refresher(owner):
+                        break
+                    if await claim_example_refresh(category):
+                        await refresh_category_examples(category)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Example refresher error: {str(e)}")
+        await asyncio.sleep(EXAMPLES_RELOAD_INTERVAL_SECONDS)
+
 # ============== Routes ==============
 
 @api_router.get("/")
 async def root():
     return {"message": "Ideæ API - Creative Assistant"}
 
+# Health Routes
+@api_router.get("/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    llm_ready = llm_warmup_done.is_set() and llm_classes is not None
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout=2)
+        db_ready = True
+    except Exception as e:
+        logger.warning(f"Readiness ping failed: {str(e)!r}")
+        db_ready = False
+    ready = llm_ready and db_ready and indexes_ready.is_set()
+    body = {
+        "status": "ready" if ready else "warming",
+        "pid": os.getpid(),
+        "llm_ready": llm_ready,
+        "db_ready": db_ready,
+        "indexes_ready": indexes_ready.is_set(),
+        **warmup_report
+    }
+    return JSONResponse(status_code=200 if ready else 503, content=body)
+
+@api_router.get("/metrics")
+async def metrics():
+    p95 = llm_latency_p95()
+    return {
+        "pid": os.getpid(),
+        "llm": {
+            **llm_metrics,
+            "breaker": llm_breaker.snapshot(),
+            "latency_p95_seconds": round(p95, 3) if p95 is not None else None,
+            "hedge_delay_seconds": round(hedge_delay(), 3) if LLM_HEDGE_ENABLED else None,
+            "hedge_budget_tokens": round(hedge_budget.tokens, 2) if LLM_HEDGE_ENABLED else None
+        }
+    }
+
 # Auth Routes
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(data: UserCreate):
@@ -307,8 +1613,44 @@ async def update_theme(data: ThemeUpdate, current_user: dict = Depends(get_curre
     )
 
 # AI Creative Routes
-@api_router.post("/creative/generate", response_model=SuggestionResponse)
-async def generate_suggestion(data: QueryRequest, current_user: dict = Depends(get_current_user)):
+async def create_suggestion(user_id: str, category: str, prompt: str, suggestion_id: Optional[str] = None) -> SuggestionResponse:
+    """Generate a suggestion upstream and record it in the user's history and stats."""
+    response = await complete_llm(CATEGORY_PROMPTS[category], prompt, f"spark-{user_id}")
+    
+    # Save query history
+    query_doc = build_query_doc(user_id, category, prompt, response, suggestion_id)
+    stored_doc = (await externalize_suggestions([query_doc]))[0]
+    try:
+        await db.queries.insert_one(stored_doc)
+    except DuplicateKeyError:
+        # A retried job already saved this row; keep it and don't count it twice
+        await release_suggestions([stored_doc["suggestion_hash"]])
+        existing = await db.queries.find_one({"id": query_doc["id"]}, {"_id": 0})
+        await resolve_suggestions([existing])
+        return SuggestionResponse(**existing)
+    except Exception:
+        await release_suggestions([stored_doc["suggestion_hash"]])
+        raise
+    await bump_user_stats(user_id, "generations", "generations_by_category", category)
+    
+    return SuggestionResponse(**query_doc)
+
+def build_query_doc(user_id: str, category: str, prompt: str, suggestion: str, suggestion_id: Optional[str] = None) -> dict:
+    now = datetime.now(timezone.utc)
+    query_doc = {
+        "id": suggestion_id or str(uuid.uuid4()),
+        "user_id": user_id,
+        "category": category,
+        "prompt": prompt,
+        "suggestion": suggestion,
+        "created_at": now.isoformat()
+    }
+    expires_at = history_expiry(now, HISTORY_TTL_DAYS)
+    if expires_at:
+        query_doc["expires_at"] = expires_at
+    return query_doc
+
+def validate_query(data: QueryRequest):
     if data.category not in CATEGORY_PROMPTS:
         raise HTTPException(status_code=400, detail="Invalid category")
     
@@ -317,56 +1659,198 @@ async def generate_suggestion(data: QueryRequest, current_user: dict = Depends(g
     if is_blocked:
         raise HTTPException(status_code=400, detail=block_reason)
     
-    api_key = os.environ.get('EMERGENT_LLM_KEY')
-    if not api_key:
+    if not os.environ.get('EMERGENT_LLM_KEY'):
         raise HTTPException(status_code=500, detail="AI service not configured")
+
+@api_router.get("/creative/examples", response_model=List[ExampleResponse])
+async def get_examples(category: Optional[str] = None, count: int = 3):
+    if category is not None and category not in CATEGORY_PROMPTS:
+        raise HTTPException(status_code=400, detail="Invalid category")
     
-    system_prompt = CATEGORY_PROMPTS[data.category]
+    pool = example_pool.get(category, []) if category else [e for examples in example_pool.values() for e in examples]
+    return [ExampleResponse(**e) for e in random.sample(pool, max(0, min(count, len(pool))))]
+
+@api_router.post("/creative/generate", response_model=SuggestionResponse)
+async def generate_suggestion(data: QueryRequest, current_user: dict = Depends(get_current_user)):
+    validate_query(data)
     
     try:
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"spark-{current_user['id']}-{uuid.uuid4()}",
-            system_message=system_prompt
-        ).with_model("openai", "gpt-5.2")
-        
-        user_message = UserMessage(text=data.prompt)
-        response = await chat.send_message(user_message)
-        
-        suggestion_id = str(uuid.uuid4())
-        created_at = datetime.now(timezone.utc).isoformat()
-        
-        # Save query history
-        query_doc = {
-            "id": suggestion_id,
-            "user_id": current_user["id"],
-            "category": data.category,
-            "prompt": data.prompt,
-            "suggestion": response,
-            "created_at": created_at
-        }
-        await db.queries.insert_one(query_doc)
-        
-        return SuggestionResponse(
-            id=suggestion_id,
-            category=data.category,
-            prompt=data.prompt,
-            suggestion=response,
-            created_at=created_at
-        )
+        return await create_suggestion(current_user["id"], data.category, data.prompt)
+    except LlmUnavailableError:
+        raise HTTPException(status_code=503, detail="AI service is temporarily unavailable, please try again shortly")
     except Exception as e:
         logging.error(f"AI generation error: {str(e)}")
         raise HTTPException(status_code=500, detail="Failed to generate suggestion")
 
+async def save_batch_results(user_id: str, query_docs: List[dict]) -> bool:
+    """Write a batch's history rows with one insert_many and its counters with one $inc."""
+    try:
+        await db.queries.insert_many(await externalize_suggestions(query_docs))
+    except Exception as e:
+        logger.error(f"Saving {len(query_docs)} batch results for {user_id} failed: {str(e)}")
+        return False
+    category_counts: Dict[Optional[str], int] = {}
+    for query_doc in query_docs:
+        category_counts[query_doc["category"]] = category_counts.get(query_doc["category"], 0) + 1
+    await bump_user_stats_many(user_id, "generations", "generations_by_category", category_counts)
+    return True
+
+@api_router.post("/creative/batch")
+async def generate_batch(data: BatchQueryRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Generate suggestions for several (category, prompt) pairs at once. Results are
+    streamed as newline-delimited JSON in completion order, each tagged with the
+    index of its item; history rows are written together once the batch finishes.
+    """
+    if not data.items:
+        raise HTTPException(status_code=400, detail="No prompts provided")
+    if len(data.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} prompts per batch")
+    
+    # Moderate the whole batch before any upstream call is made
+    for item in data.items:
+        validate_query(item)
+    
+    user_id = current_user["id"]
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_item(index: int, item: QueryRequest):
+        async with semaphore:
+            try:
+                response = await complete_llm(CATEGORY_PROMPTS[item.category], item.prompt, f"spark-{user_id}")
+                return index, build_query_doc(user_id, item.category, item.prompt, response), None
+            except LlmUnavailableError:
+                return index, None, "AI service is temporarily unavailable, please try again shortly"
+            except Exception as e:
+                logging.error(f"AI batch generation error: {str(e)}")
+                return index, None, "Failed to generate suggestion"
+    
+    async def stream_results():
+        tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(data.items)]
+        query_docs = []
+        streamed = set()
+        save: Optional[asyncio.Task] = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, query_doc, error = await next_done
+                streamed.add(index)
+                line = {"index": index}
+                if query_doc:
+                    query_docs.append(query_doc)
+                    line["result"] = SuggestionResponse(**query_doc).model_dump()
+                else:
+                    line["error"] = error
+                yield json.dumps(line) + "\n"
+            
+            saved = True
+            if query_docs:
+                # Shielded so a disconnect during the write doesn't abort it
+                save = spawn_background(save_batch_results(user_id, query_docs))
+                saved = await asyncio.shield(save)
+            if not saved:
+                yield json.dumps({"error": "Results could not be saved to history"}) + "\n"
+            yield json.dumps({"done": True, "succeeded": len(query_docs), "failed": len(tasks) - len(query_docs)}) + "\n"
+        finally:
+            if save is None:
+                # Items that finished but were never streamed are still worth keeping
+                for task in tasks:
+                    if task.done() and not task.cancelled():
+                        index, query_doc, _ = task.result()
+                        if query_doc and index not in streamed:
+                            query_docs.append(query_doc)
+            for task in tasks:
+                task.cancel()
+            if query_docs and save is None:
+                # The client went away mid-stream: still keep what was generated
+                spawn_background(save_batch_results(user_id, list(query_docs)))
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@api_router.post("/creative/jobs", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_generation_job(
+    data: QueryRequest,
+    idempotency_key: Optional[str] = Header(default=None),
+    current_user: dict = Depends(get_current_user)
+):
+    validate_query(data)
+    
+    now = datetime.now(timezone.utc)
+    job_doc = {
+        "id": str(uuid.uuid4()),
+        "user_id": current_user["id"],
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
+        "category": data.category,
+        "prompt": data.prompt,
+        "status": "queued",
+        "attempts": 0,
+        "result": None,
+        "error": None,
+        "available_at": now,
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat()
+    }
+    
+    # A retried request with the same key returns the job it already created;
+    # reusing the key for a different request is a client error
+    try:
+        await db.generation_jobs.insert_one(job_doc)
+        job_queue_signal.set()
+    except DuplicateKeyError:
+        job_doc = await db.generation_jobs.find_one(
+            {"user_id": current_user["id"], "idempotency_key": idempotency_key},
+            {"_id": 0}
+        )
+        if (job_doc["category"], job_doc["prompt"]) != (data.category, data.prompt):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Idempotency-Key was already used for a different request"
+            )
+        unpack_job_result(job_doc)
+    
+    return JobResponse(**job_doc)
+
+@api_router.get("/creative/jobs/{job_id}", response_model=JobResponse)
+async def get_generation_job(job_id: str, wait: int = 0, current_user: dict = Depends(get_current_user)):
+    job = await wait_for_job(job_id, current_user["id"], max(0, min(wait, JOB_MAX_WAIT_SECONDS)))
+    
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return JobResponse(**job)
+
 @api_router.get("/creative/history", response_model=List[SuggestionResponse])
 async def get_history(current_user: dict = Depends(get_current_user)):
     queries = await db.queries.find(
         {"user_id": current_user["id"]},
-        {"_id": 0}
+        {"_id": 0, "expires_at": 0}
     ).sort("created_at", -1).limit(50).to_list(50)
+    await resolve_suggestions(queries)
     
     return [SuggestionResponse(**q) for q in queries]
 
+@api_router.get("/creative/history/archived", response_model=List[SuggestionResponse])
+async def get_archived_history(
+    before: Optional[str] = None,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {"user_id": current_user["id"]}
+    if before:
+        query["first_created_at"] = {"$lt": before}
+    
+    rows: List[dict] = []
+    cursor = db.query_archives.find(query, {"_id": 0, "payload": 1}).sort("last_created_at", -1)
+    async for archive in cursor:
+        rows.extend(
+            row for row in unpack_history(archive["payload"])
+            if not before or row["created_at"] < before
+        )
+        if len(rows) >= limit:
+            break
+    
+    rows.sort(key=lambda row: row["created_at"], reverse=True)
+    return [SuggestionResponse(**row) for row in rows[:limit]]
+
 # Favorites Routes
 @api_router.post("/favorites", response_model=FavoriteResponse)
 async def add_favorite(data: FavoriteCreate, current_user: dict = Depends(get_current_user)):
@@ -380,7 +1864,13 @@ async def add_favorite(data: FavoriteCreate, current_user: dict = Depends(get_cu
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.favorites.insert_one(favorite_doc)
+    stored_doc = (await externalize_suggestions([favorite_doc]))[0]
+    try:
+        await db.favorites.insert_one(stored_doc)
+    except Exception:
+        await release_suggestions([stored_doc["suggestion_hash"]])
+        raise
+    await bump_user_stats(current_user["id"], "favorites", "favorites_by_category", data.category)
     
     return FavoriteResponse(**favorite_doc)
 
@@ -390,19 +1880,23 @@ async def get_favorites(current_user: dict = Depends(get_current_user)):
         {"user_id": current_user["id"]},
         {"_id": 0}
     ).sort("created_at", -1).to_list(100)
+    await resolve_suggestions(favorites)
     
     return [FavoriteResponse(**f) for f in favorites]
 
 @api_router.delete("/favorites/{favorite_id}")
 async def delete_favorite(favorite_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.favorites.delete_one({
-        "id": favorite_id,
-        "user_id": current_user["id"]
-    })
+    favorite = await db.favorites.find_one_and_delete(
+        {"id": favorite_id, "user_id": current_user["id"]},
+        projection={"_id": 0, "category": 1, "suggestion_hash": 1}
+    )
     
-    if result.deleted_count == 0:
+    if not favorite:
         raise HTTPException(status_code=404, detail="Favorite not found")
     
+    await release_suggestions([favorite.get("suggestion_hash")])
+    await bump_user_stats(current_user["id"], "favorites", "favorites_by_category", favorite.get("category"), -1)
+    
     return {"message": "Favorite deleted"}
 
 class FavoriteUpdate(BaseModel):
@@ -410,15 +1904,21 @@ class FavoriteUpdate(BaseModel):
 
 @api_router.put("/favorites/{favorite_id}", response_model=FavoriteResponse)
 async def update_favorite(favorite_id: str, data: FavoriteUpdate, current_user: dict = Depends(get_current_user)):
-    result = await db.favorites.update_one(
+    # Copy-on-write: edited text gets its own blob, the history row keeps the original
+    [new_hash] = await store_suggestions([data.suggestion])
+    favorite = await db.favorites.find_one_and_update(
         {"id": favorite_id, "user_id": current_user["id"]},
-        {"$set": {"suggestion": data.suggestion}}
+        {"$set": {"suggestion_hash": new_hash}, "$unset": {"suggestion": ""}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.matched_count == 0:
+    if not favorite:
+        await release_suggestions([new_hash])
         raise HTTPException(status_code=404, detail="Favorite not found")
     
-    favorite = await db.favorites.find_one({"id": favorite_id}, {"_id": 0})
+    await release_suggestions([favorite.pop("suggestion_hash", None)])
+    favorite["suggestion"] = data.suggestion
     return FavoriteResponse(**favorite)
 
 # ============== My Ideas Routes ==============
@@ -444,6 +1944,7 @@ async def create_idea(data: IdeaCreate, current_user: dict = Depends(get_current
     }
     
     await db.ideas.insert_one(idea_doc)
+    await bump_user_stats(current_user["id"], "ideas", "ideas_by_type", data.idea_type)
     
     return IdeaResponse(**idea_doc)
 
@@ -496,14 +1997,16 @@ async def update_idea(idea_id: str, data: IdeaUpdate, current_user: dict = Depen
 
 @api_router.delete("/ideas/{idea_id}")
 async def delete_idea(idea_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.ideas.delete_one({
-        "id": idea_id,
-        "user_id": current_user["id"]
-    })
+    idea = await db.ideas.find_one_and_delete(
+        {"id": idea_id, "user_id": current_user["id"]},
+        projection={"_id": 0, "idea_type": 1}
+    )
     
-    if result.deleted_count == 0:
+    if not idea:
         raise HTTPException(status_code=404, detail="Idea not found")
     
+    await bump_user_stats(current_user["id"], "ideas", "ideas_by_type", idea.get("idea_type"), -1)
+    
     return {"message": "Idea deleted"}
 
 # Share idea - make it public
@@ -551,6 +2054,8 @@ async def get_shared_idea(share_id: str):
     if not idea:
         raise HTTPException(status_code=404, detail="Shared idea not found")
     
+    record_view(share_id)
+    
     return SharedIdeaResponse(
         id=idea["id"],
         title=idea["title"],
@@ -558,18 +2063,26 @@ async def get_shared_idea(share_id: str):
         idea_type=idea["idea_type"],
         media_url=idea.get("media_url"),
         author_name=idea.get("author_name", "Anonymous"),
+        view_count=idea.get("view_count", 0) + pending_views.get(share_id, 0),
         created_at=idea["created_at"]
     )
 
 # Public endpoint - browse all shared ideas (no auth required)
 @api_router.get("/shared", response_model=List[SharedIdeaResponse])
-async def get_all_shared_ideas(limit: int = 50):
+async def get_all_shared_ideas(limit: int = 50, sort: str = "recent"):
+    if sort == "recent":
+        order = [("created_at", -1)]
+    elif sort == "popular":
+        order = [("view_count", -1), ("created_at", -1)]
+    else:
+        raise HTTPException(status_code=400, detail="Invalid sort")
+    
     ideas = await db.ideas.find(
         {"is_public": True},
         {"_id": 0}
-    ).sort("created_at", -1).limit(limit).to_list(limit)
+    ).sort(order).limit(limit).to_list(limit)
     
-    return [
+    shared = [
         SharedIdeaResponse(
             id=idea["id"],
             title=idea["title"],
@@ -577,10 +2090,142 @@ async def get_all_shared_ideas(limit: int = 50):
             idea_type=idea["idea_type"],
             media_url=idea.get("media_url"),
             author_name=idea.get("author_name", "Anonymous"),
+            view_count=idea.get("view_count", 0) + pending_views.get(idea.get("share_id"), 0),
             created_at=idea["created_at"]
         )
         for idea in ideas
     ]
+    if sort == "popular":
+        # Unflushed views can reorder the page; the sort is stable, so ties keep newest first
+        shared.sort(key=lambda idea: idea.view_count, reverse=True)
+    return shared
+
+# ============== Stats Routes ==============
+
+@api_router.get("/stats", response_model=UserStatsResponse)
+async def get_stats(current_user: dict = Depends(get_current_user)):
+    stats = await db.user_stats.find_one({"user_id": current_user["id"]}, {"_id": 0})
+    if not stats:
+        return UserStatsResponse(user_id=current_user["id"])
+    return UserStatsResponse(**stats)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# ============== App Lifecycle ==============
+
+background_tasks: List[asyncio.Task] = []
+
+indexes_ready = asyncio.Event()
+
+INDEXES = {
+    "user_stats": [IndexModel("user_id", unique=True)],
+    "queries": [
+        IndexModel("id", unique=True),
+        IndexModel([("user_id", 1), ("created_at", -1)]),
+        IndexModel("expires_at", sparse=True)
+    ],
+    "query_archives": [
+        IndexModel([("user_id", 1), ("last_created_at", -1)]),
+        IndexModel("expires_at", sparse=True)
+    ],
+    "history_archive_locks": [IndexModel("user_id", unique=True)],
+    "generation_jobs": [
+        IndexModel("id", unique=True),
+        IndexModel([("user_id", 1), ("idempotency_key", 1)], unique=True),
+        IndexModel([("status", 1), ("created_at", 1)]),
+        IndexModel("expires_at", expireAfterSeconds=0)
+    ],
+    "category_examples": [IndexModel("category", unique=True)],
+    "ideas": [
+        IndexModel("share_id", sparse=True),
+        IndexModel([("is_public", 1), ("created_at", -1)]),
+        IndexModel([("is_public", 1), ("view_count", -1), ("created_at", -1)])
+    ]
+}
+
+# Indexes from earlier releases that must not exist any more
+OBSOLETE_INDEXES = {
+    # TTL deletes skipped blob release and the pruned-generation tally;
+    # purge_expired_history and purge_expired_archives replace them
+    "queries": ["expires_at_1"],
+    "query_archives": ["expires_at_1"]
+}
+
+async def ensure_indexes():
+    existing = {
+        collection: await db[collection].index_information()
+        for collection in OBSOLETE_INDEXES
+    }
+    for collection, names in OBSOLETE_INDEXES.items():
+        for name in names:
+            if name in existing[collection] and "expireAfterSeconds" in existing[collection][name]:
+                await db[collection].drop_index(name)
+    # One createIndexes command per collection; existing indexes are a no-op
+    for collection, models in INDEXES.items():
+        await db[collection].create_indexes(models)
+
+async def build_indexes():
+    """Create indexes off the start-up path, retrying until Mongo is reachable."""
+    delay = 5
+    while True:
+        try:
+            await ensure_indexes()
+            indexes_ready.set()
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Index creation failed, retrying in {delay}s: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+def reset_runtime_state():
+    """
+    Give each lifespan fresh events. They bind to the loop that first awaits them
+    and stay set once set, so reusing them across lifespans in one process (tests,
+    reloads) would break the workers and report readiness too early.
+    """
+    global llm_warmup_done, job_queue_signal, indexes_ready
+    llm_warmup_done = asyncio.Event()
+    job_queue_signal = asyncio.Event()
+    indexes_ready = asyncio.Event()
+    warmup_report.clear()
+    job_waiters.clear()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    reset_runtime_state()
+    connect_db()
+    background_tasks.append(asyncio.create_task(warm_up_llm()))
+    background_tasks.append(asyncio.create_task(build_indexes()))
+    if HISTORY_ARCHIVE_INTERVAL_SECONDS > 0:
+        background_tasks.append(asyncio.create_task(run_history_archiver()))
+    background_tasks.append(asyncio.create_task(run_example_refresher()))
+    background_tasks.append(asyncio.create_task(run_view_flusher()))
+    for _ in range(GENERATION_WORKERS):
+        background_tasks.append(asyncio.create_task(run_generation_worker()))
+    try:
+        yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        # Let detached writes (e.g. batch history) finish before the client closes
+        await asyncio.gather(*detached_tasks, return_exceptions=True)
+        try:
+            await flush_view_counts()
+        except Exception as e:
+            logger.error(f"Final view count flush failed: {str(e)}")
+        client.close()
+
+# Create the main app
+app = FastAPI(lifespan=lifespan)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -593,13 +2238,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ideæ backend maintenance jobs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild-stats", help="Recompute per-user usage counters")
+    rebuild.add_argument("--batch-size", type=int, default=STATS_REBUILD_BATCH_SIZE)
+
+    archive = subparsers.add_parser("archive-history", help="Move old query history into compressed archives")
+    archive.add_argument("--keep", type=int, default=HISTORY_HOT_LIMIT)
+    archive.add_argument("--batch-size", type=int, default=HISTORY_ARCHIVE_BATCH_SIZE)
+
+    migrate = subparsers.add_parser("migrate-suggestions", help="Move inline suggestion text into the deduplicated store")
+    migrate.add_argument("--batch-size", type=int, default=SUGGESTION_MIGRATION_BATCH_SIZE)
+    args = parser.parse_args()
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+    connect_db()
+    if args.command == "rebuild-stats":
+        count = asyncio.run(rebuild_user_stats(args.batch_size))
+        logger.info(f"Rebuilt usage stats for {count} users")
+    elif args.command == "archive-history":
+        purged, expired_archives, count = asyncio.run(run_history_retention(args.keep, args.batch_size))
+        logger.info(f"Purged {purged} expired rows and {expired_archives} archives, archived {count} history rows")
+    elif args.command == "migrate-suggestions":
+        report = asyncio.run(migrate_suggestions(args.batch_size))
+        logger.info(f"Suggestion store migration: {report}")
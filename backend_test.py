@@ -5,6 +5,7 @@ import sys
 import json
 from datetime import datetime
 import uuid
+import time
 
 class SparkAPITester:
     def __init__(self, base_url="https://creative-genius-6.preview.emergentagent.com"):
@@ -199,6 +200,108 @@ class SparkAPITester:
             return True
         return False
 
+    def test_stats(self):
+        """Test per-user usage counters"""
+        if not self.token:
+            self.log_test("Usage Stats", False, "No auth token available")
+            return False
+            
+        success, response = self.run_test("Usage Stats", "GET", "stats", 200)
+        
+        if success and response.get('user_id') == self.user_id:
+            print(f"   📊 Generations: {response.get('generations')}, favorites: {response.get('favorites')}")
+            return True
+        return False
+
+    def test_generation_job(self):
+        """Test async generation job with idempotent retry and long-poll"""
+        if not self.token:
+            self.log_test("Generation Job", False, "No auth token available")
+            return False
+            
+        job_data = {
+            "category": "project-names",
+            "prompt": "A mobile app for swapping houseplants"
+        }
+        idempotency = {'Idempotency-Key': f"test-{uuid.uuid4().hex}"}
+        
+        success, job = self.run_test("Create Generation Job", "POST", "creative/jobs", 202, job_data, idempotency)
+        if not success or 'id' not in job:
+            return False
+            
+        success, retry = self.run_test("Retry Generation Job", "POST", "creative/jobs", 202, job_data, idempotency)
+        if not success or retry.get('id') != job['id']:
+            self.log_test("Generation Job Idempotency", False, "Retry created a new job")
+            return False
+        
+        reused = {**job_data, "prompt": "A different request under the same key"}
+        success, _ = self.run_test("Reuse Idempotency Key", "POST", "creative/jobs", 409, reused, idempotency)
+        if not success:
+            return False
+            
+        deadline = time.time() + 90
+        while time.time() < deadline:
+            success, result = self.run_test("Poll Generation Job", "GET", f"creative/jobs/{job['id']}?wait=25", 200)
+            if not success:
+                return False
+            if result.get('status') in ('done', 'failed'):
+                break
+        
+        if result.get('status') == 'done' and result.get('result', {}).get('suggestion'):
+            print(f"   ⏳ Job finished: {result['result']['suggestion'][:50]}...")
+            return True
+        self.log_test("Generation Job Result", False, f"Job ended as {result.get('status')}")
+        return False
+
+    def test_batch_generation(self):
+        """Test streamed batch generation"""
+        if not self.token:
+            self.log_test("Batch Generation", False, "No auth token available")
+            return False
+            
+        batch_data = {"items": [
+            {"category": "project-names", "prompt": "A podcast about forgotten inventions"},
+            {"category": "content-ideas", "prompt": "Posts for a local bookstore"}
+        ]}
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.token}'}
+        
+        try:
+            response = requests.post(f"{self.base_url}/api/creative/batch", json=batch_data, headers=headers, stream=True, timeout=120)
+            lines = [json.loads(line) for line in response.iter_lines() if line]
+        except Exception as e:
+            self.log_test("Batch Generation", False, f"Request failed: {str(e)}")
+            return False
+        
+        results = [line for line in lines if 'index' in line]
+        done = lines[-1] if lines else {}
+        if response.status_code == 200 and len(results) == 2 and done.get('done'):
+            self.log_test("Batch Generation", True)
+            print(f"   📦 Batch: {done.get('succeeded')} succeeded, {done.get('failed')} failed")
+            return True
+        self.log_test("Batch Generation", False, f"Status {response.status_code}, lines: {lines}")
+        return False
+
+    def test_examples(self):
+        """Test precomputed category examples"""
+        success, response = self.run_test("Category Examples", "GET", "creative/examples?category=writing&count=2", 200)
+        if success and isinstance(response, list) and len(response) <= 2:
+            print(f"   💡 {len(response)} examples available")
+            return True
+        return False
+
+    def test_shared_popular(self):
+        """Test popular sort on shared ideas"""
+        success, response = self.run_test("Shared Ideas Popular", "GET", "shared?sort=popular&limit=10", 200)
+        if not success:
+            return False
+            
+        counts = [idea.get('view_count', 0) for idea in response]
+        if counts != sorted(counts, reverse=True):
+            self.log_test("Shared Ideas Popular Order", False, f"Not ordered by views: {counts}")
+            return False
+            
+        return self.run_test("Shared Ideas Invalid Sort", "GET", "shared?sort=bogus", 400)[0]
+
     def test_invalid_endpoints(self):
         """Test error handling for invalid requests"""
         # Test invalid category
@@ -241,6 +344,11 @@ class SparkAPITester:
         self.test_creative_history()
         self.test_favorites_crud()
         self.test_theme_update()
+        self.test_stats()
+        self.test_generation_job()
+        self.test_batch_generation()
+        self.test_examples()
+        self.test_shared_popular()
         
         # Error handling tests
         self.test_invalid_endpoints()
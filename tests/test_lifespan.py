@@ -0,0 +1,21 @@
+import time
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_repeated_lifespans_get_fresh_state(monkeypatch):
+    # Nothing listens on port 1, so Mongo work fails fast and readiness stays false
+    monkeypatch.setattr(server, "mongo_url", "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=100")
+    monkeypatch.setattr(server, "JOB_POLL_INTERVAL_SECONDS", 0.05)
+
+    for _ in range(2):
+        with TestClient(server.app) as client:
+            time.sleep(0.3)
+            assert client.get("/api/health/live").status_code == 200
+            ready = client.get("/api/health/ready")
+            assert ready.status_code == 503
+            assert ready.json()["indexes_ready"] is False
+            workers = server.background_tasks[-server.GENERATION_WORKERS:]
+            assert workers and not any(task.done() for task in workers)
@@ -0,0 +1,181 @@
+import asyncio
+from collections import deque
+
+import pytest
+
+import server
+from server import CircuitBreaker
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(breaker.allow(), False)
+    assert breaker.state == "open"
+
+
+def test_breaker_opens_at_error_rate():
+    breaker = CircuitBreaker(window=4, min_calls=4, error_rate=0.5, cooldown=60)
+    breaker.record(breaker.allow(), True)
+    breaker.record(breaker.allow(), True)
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == "closed"
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == "open"
+    assert breaker.allow() is None
+    assert breaker.times_opened == 1
+
+
+def test_breaker_needs_min_calls_before_opening():
+    breaker = CircuitBreaker(window=10, min_calls=3, error_rate=0.5, cooldown=60)
+    breaker.record(breaker.allow(), False)
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == "closed"
+
+
+def test_breaker_admits_single_probe_after_cooldown():
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, cooldown=0)
+    open_breaker(breaker)
+    probe = breaker.allow()
+    assert probe is not None
+    assert breaker.state == "half_open"
+    assert breaker.allow() is None
+
+
+def test_breaker_probe_success_closes_and_failure_reopens():
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, cooldown=0)
+    open_breaker(breaker)
+    breaker.record(breaker.allow(), True)
+    assert breaker.state == "closed"
+
+    open_breaker(breaker)
+    breaker.record(breaker.allow(), False)
+    assert breaker.state == "open"
+    assert breaker.times_opened == 3
+
+
+def test_breaker_ignores_calls_admitted_before_it_opened():
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, cooldown=0)
+    stale = breaker.allow()
+    open_breaker(breaker)
+    probe = breaker.allow()
+
+    breaker.record(stale, True)
+    assert breaker.state == "half_open"
+    assert breaker.probe_in_flight
+
+    breaker.record(probe, True)
+    assert breaker.state == "closed"
+
+
+def test_breaker_abandoned_probe_allows_another():
+    breaker = CircuitBreaker(window=4, min_calls=2, error_rate=0.5, cooldown=0)
+    open_breaker(breaker)
+    probe = breaker.allow()
+    breaker.abandon(probe)
+    assert breaker.allow() is not None
+
+
+def test_latency_p95():
+    assert server.llm_latency_p95([]) is None
+    assert server.llm_latency_p95([3.0]) == 3.0
+    samples = [float(n) for n in range(1, 101)]
+    assert server.llm_latency_p95(samples) == 96.0
+
+
+def test_hedge_delay_uses_default_until_enough_samples(monkeypatch):
+    monkeypatch.setattr(server, "LLM_HEDGE_MIN_SAMPLES", 20)
+    monkeypatch.setattr(server, "LLM_HEDGE_DEFAULT_DELAY_SECONDS", 15.0)
+    monkeypatch.setattr(server, "LLM_HEDGE_MIN_DELAY_SECONDS", 2.0)
+    assert server.hedge_delay([5.0] * 19) == 15.0
+    assert server.hedge_delay([5.0] * 20) == 5.0
+    assert server.hedge_delay([0.5] * 20) == 2.0
+
+
+def test_hedged_send_cancels_upstream_when_caller_is_cancelled(monkeypatch):
+    started = []
+    cancelled = []
+
+    async def slow_send(*args, **kwargs):
+        started.append(True)
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(server, "_send_llm", slow_send)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 30)
+
+    async def scenario():
+        caller = asyncio.create_task(server._send_hedged("model", "system", "prompt", "test"))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+        # Checked inside the loop: asyncio.run() would cancel leftovers on exit anyway
+        assert started == [True]
+        assert cancelled == [True]
+
+    asyncio.run(scenario())
+
+
+def test_hedged_send_returns_hedge_when_first_is_slow(monkeypatch):
+    calls = []
+
+    async def send(*args, **kwargs):
+        calls.append(True)
+        if len(calls) == 1:
+            await asyncio.sleep(60)
+        return f"answer {len(calls)}"
+
+    monkeypatch.setattr(server, "_send_llm", send)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 0.01)
+
+    assert asyncio.run(server._send_hedged("model", "system", "prompt", "test")) == "answer 2"
+
+
+def test_hedge_budget_limits_hedge_rate():
+    budget = server.HedgeBudget(ratio=0.05, burst=2)
+    hedges = 0
+    for _ in range(1000):
+        budget.earn()
+        if budget.try_spend():
+            hedges += 1
+    # Burst plus 5% of calls, never more
+    assert hedges <= 2 + 50
+    assert hedges >= 49
+
+
+def test_hedged_send_skips_hedge_when_budget_is_spent(monkeypatch):
+    calls = []
+
+    async def send(*args, **kwargs):
+        calls.append(True)
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    monkeypatch.setattr(server, "_send_llm", send)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 0.01)
+    monkeypatch.setattr(server, "hedge_budget", server.HedgeBudget(ratio=0, burst=0))
+
+    assert asyncio.run(server._send_hedged("model", "system", "prompt", "test")) == "primary"
+    assert calls == [True]
+
+
+def test_hedged_send_records_censored_loser_latency(monkeypatch):
+    async def send(*args, **kwargs):
+        if not hasattr(send, "called"):
+            send.called = True
+            await asyncio.sleep(60)
+        return "hedge"
+
+    samples = deque()
+    monkeypatch.setattr(server, "_send_llm", send)
+    monkeypatch.setattr(server, "hedge_delay", lambda: 0.05)
+    monkeypatch.setattr(server, "hedge_budget", server.HedgeBudget(ratio=0, burst=1))
+    monkeypatch.setattr(server, "llm_latencies", samples)
+
+    assert asyncio.run(server._send_hedged("model", "system", "prompt", "test")) == "hedge"
+    assert len(samples) == 1
+    assert samples[0] >= 0.05
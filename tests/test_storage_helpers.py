@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import server
+from server import SuggestionResponse
+
+
+def test_stat_key_sanitises_field_names():
+    assert server.stat_key("content-ideas") == "content-ideas"
+    assert server.stat_key("a.b$c") == "a_b_c"
+    assert server.stat_key(None) == "unknown"
+    assert server.stat_key("") == "unknown"
+
+
+def test_suggestion_hash_is_stable_sha256():
+    assert server.suggestion_hash("idea") == server.suggestion_hash("idea")
+    assert server.suggestion_hash("idea") != server.suggestion_hash("idea ")
+    assert len(server.suggestion_hash("idea")) == 64
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "short",
+    "Ideæ — ünïcödé ✨ suggestions",
+    "1. A lighthouse keeper who collects storms.\n" * 200,
+])
+def test_suggestion_compression_round_trip(text):
+    encoding, data = server.compress_suggestion(text)
+    assert encoding in ("zstd", "zlib", "raw")
+    assert server.decompress_suggestion(encoding, data) == text
+
+
+def test_compression_falls_back_to_raw_when_it_does_not_help():
+    assert server.compress_suggestion("hi")[0] == "raw"
+
+
+def test_repetitive_text_is_compressed():
+    text = "Provide 3 distinct creative suggestions. " * 100
+    encoding, data = server.compress_suggestion(text)
+    assert encoding != "raw"
+    assert len(data) < len(text.encode("utf-8")) // 5
+
+
+def test_zlib_used_without_zstandard(monkeypatch):
+    monkeypatch.setattr(server, "zstandard", None)
+    text = "zlib please " * 50
+    encoding, data = server.compress_suggestion(text)
+    assert encoding == "zlib"
+    assert server.decompress_suggestion(encoding, data) == text
+
+
+def test_history_pack_round_trip():
+    rows = [
+        {"id": "1", "category": "writing", "prompt": "p", "suggestion": "s ✨", "created_at": "2026-01-02T00:00:00+00:00"},
+        {"id": "2", "category": "design", "prompt": "q", "suggestion": "t", "created_at": "2026-01-01T00:00:00+00:00"},
+    ]
+    assert server.unpack_history(server.pack_history(rows)) == rows
+
+
+def test_archive_body_summarises_rows():
+    rows = [
+        {"id": "1", "category": "writing", "created_at": "2026-01-03"},
+        {"id": "2", "category": "writing", "created_at": "2026-01-02"},
+        {"id": "3", "category": "design", "created_at": "2026-01-01"},
+    ]
+    body = server._archive_body(rows)
+    assert body["count"] == 3
+    assert body["first_created_at"] == "2026-01-01"
+    assert body["last_created_at"] == "2026-01-03"
+    assert body["category_counts"] == {"writing": 2, "design": 1}
+    assert server.unpack_history(body["payload"]) == rows
+
+
+def test_job_result_round_trip():
+    suggestion = SuggestionResponse(
+        id="job-1", category="writing", prompt="p", suggestion="a long answer " * 20, created_at="2026-01-01"
+    )
+    job = {"id": "job-1", "status": "done", **server.pack_job_result(suggestion)}
+    assert "suggestion" not in job["result"]
+    assert server.unpack_job_result(job)["result"] == suggestion.model_dump()
+    assert "result_data" not in job
+
+
+def test_unpack_job_result_leaves_pending_jobs_alone():
+    job = {"id": "job-2", "status": "queued", "result": None}
+    assert server.unpack_job_result(dict(job)) == job
+
+
+def finished_write(result=None, error=None):
+    write = asyncio.get_running_loop().create_future()
+    if error is None:
+        write.set_result(result)
+    else:
+        write.set_exception(error)
+    return write
+
+
+def test_unapplied_views_keeps_only_failed_ops():
+    async def check():
+        share_ids = ["a", "b", "c"]
+        assert server.unapplied_views(finished_write(), share_ids) == []
+
+        partial = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000}]})
+        assert server.unapplied_views(finished_write(error=partial), share_ids) == ["b"]
+
+        unknown = finished_write(error=ConnectionError("reset"))
+        assert server.unapplied_views(unknown, share_ids) == share_ids
+
+        cancelled = asyncio.get_running_loop().create_future()
+        cancelled.cancel()
+        assert server.unapplied_views(cancelled, share_ids) == share_ids
+
+    asyncio.run(check())